@@ -0,0 +1,60 @@
+from datetime import datetime
+from typing import Literal
+
+import msgspec
+
+# msgspec mirrors of the messages in `_types`, used to decode trusted transcripts. msgspec decodes JSON straight
+# into these structs, several times faster than parsing it into dicts and building models from them.
+
+
+class ContentTextStruct(msgspec.Struct, tag_field="type", tag="text"):
+    text: str
+
+
+class ContentImageStruct(msgspec.Struct, tag_field="type", tag="image"):
+    image: str
+    mime: str = "image/jpeg"
+
+
+class MessageStruct(msgspec.Struct):
+    role: Literal["user", "assistant"]
+    content: list[ContentTextStruct | ContentImageStruct]
+    created_at: datetime
+
+
+class ContentImageBytesStruct(msgspec.Struct, tag_field="type", tag="image"):
+    # Encoded image, stored as MessagePack binary instead of base64
+    image: bytes
+    mime: str
+
+
+class BinaryMessageStruct(msgspec.Struct):
+    role: Literal["user", "assistant"]
+    content: list[ContentTextStruct | ContentImageBytesStruct]
+    created_at: datetime
+
+
+class ChatSessionStruct(msgspec.Struct):
+    schema_version: int
+    llm_name: str
+    llm_kwargs: dict
+    messages: list[BinaryMessageStruct]
+
+
+def msgpack_header(kind: Literal["map", "array"], length: int) -> bytes:
+    """
+    MessagePack header of a map or an array with `length` items, so that its items can be encoded one by one
+    after it. A `ChatSessionStruct` is encoded as a map of its fields, which is decoded back into the struct.
+    """
+    fix_prefix, prefix16, prefix32 = (0x80, 0xDE, 0xDF) if kind == "map" else (0x90, 0xDC, 0xDD)
+    if length < 16:
+        return bytes([fix_prefix | length])
+    if length < 2**16:
+        return bytes([prefix16]) + length.to_bytes(2, "big")
+    return bytes([prefix32]) + length.to_bytes(4, "big")
+
+
+# Built once, since building a decoder compiles its schema
+MESSAGE_DECODER = msgspec.json.Decoder(MessageStruct)
+CHAT_SESSION_MSGPACK_ENCODER = msgspec.msgpack.Encoder()
+CHAT_SESSION_MSGPACK_DECODER = msgspec.msgpack.Decoder(ChatSessionStruct)
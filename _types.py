@@ -1,84 +1,426 @@
 from __future__ import annotations
 
+import fcntl
+import io
 import json
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Literal
 
 from PIL import Image
-from pydantic import BaseModel, model_serializer
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator, model_serializer
 
 import files
 
+try:
+    # Faster decoding of trusted transcripts
+    import _structs
+except ImportError:
+    _structs = None
+
+try:
+    # Parses and serializes JSON several times faster than the standard library, e.g. legacy chats with
+    # base64 images embedded in the JSON file
+    import orjson
+except ImportError:
+    orjson = None
+
+# Transcripts store one JSON-serialized message per line, next to the JSON metadata file of a chat session
+TRANSCRIPT_SUFFIX = ".jsonl"
+# Image formats accepted by the APIs, which are sent the original bytes of images in these formats
+API_IMAGE_MIMES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+# Chat sessions can also be saved as a single MessagePack file, which stores images as binary instead of base64
+MSGPACK_SUFFIX = ".msgpack"
+# Version of the transcript format written by `save_to_path`, recorded in the chat session metadata.
+# Bump it whenever the serialized format of `Message` changes.
+SCHEMA_VERSION = 1
+
+
+def _json_loads(data: str | bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
 
 class ContentTextMessage(BaseModel):
+    # Build validators and serializers on first use rather than at import time
+    model_config = ConfigDict(defer_build=True)
+
     type: str = "text"
     text: str
 
 
 class ContentImageMessage(BaseModel):
+    # Allow arbitrary types so that Pydantic doesn't complain about Image.Image type
+    model_config = ConfigDict(arbitrary_types_allowed=True, defer_build=True)
+
     type: str = "image"
-    image: Image.Image
+    image: Image.Image | files.LazyImage
+    # Encoded bytes the image was read from, and their mime type.
+    # They are sent to APIs as is, instead of re-encoding the image to JPEG.
+    original_bytes: bytes | None = None
+    mime: str = "image/jpeg"
+
+    _base64_image: str | None = PrivateAttr(default=None)
+
+    @staticmethod
+    def from_path(file_path: str | Path) -> ContentImageMessage:
+        """
+        Create an image message from an image file, keeping its encoded bytes if APIs accept its format.
+
+        Args:
+            file_path (str | Path): Path to the image file.
+
+        Returns:
+            ContentImageMessage: The image message.
+        """
+        image_bytes = Path(file_path).expanduser().read_bytes()
+        image = Image.open(io.BytesIO(image_bytes))
+        mime = image.get_format_mimetype()
+        if mime not in API_IMAGE_MIMES:
+            return ContentImageMessage(image=image)
+        return ContentImageMessage(image=image, original_bytes=image_bytes, mime=mime)
+
+    def to_base64(self) -> tuple[str, str]:
+        """
+        Base64-encode the image, reusing its original or deserialized encoding if there is one.
+
+        Returns:
+            tuple[str, str]: The base64-encoded image and its mime type.
+        """
+        if self.original_bytes is not None:
+            if self._base64_image is None:
+                self._base64_image = files.bytes_to_base64(self.original_bytes)
+            return self._base64_image, self.mime
+        if isinstance(self.image, files.LazyImage):
+            return self.image.base64_image, self.mime
+        return files.pil_to_base64(self.image), "image/jpeg"
+
+    def to_bytes(self) -> tuple[bytes, str]:
+        """
+        Encoded bytes of the image, reusing its original or deserialized encoding if there is one.
 
-    class Config:
-        # Allow arbitrary types so that Pydantic doesn't complain about Image.Image type
-        arbitrary_types_allowed = True
+        Returns:
+            tuple[bytes, str]: The encoded image and its mime type.
+        """
+        if self.original_bytes is not None:
+            return self.original_bytes, self.mime
+        base64_image, mime = self.to_base64()
+        return files.base64_to_bytes(base64_image), mime
+
+    @field_validator("image", mode="before")
+    @classmethod
+    def deserialize_image(cls, value: Any) -> Any:
+        # Keep images deserialized from base64 strings encoded until they are needed
+        return files.LazyImage(value) if isinstance(value, str) else value
 
     @model_serializer
     def serialize_model(self) -> dict[str, Any]:
         # Serialize the image to a base64 string
-        image_base64 = files.pil_to_base64(self.image)
-        return {"type": self.type, "image": image_base64}
+        image_base64, mime = self.to_base64()
+        return {"type": self.type, "image": image_base64, "mime": mime}
 
 
 class Message(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     role: Literal["user", "assistant"]
     content: list[ContentTextMessage | ContentImageMessage]
-    created_at: datetime
+    # Set when the message is created, unless given, e.g. when loading a saved message
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    def dump_json_line(self) -> bytes:
+        """
+        Serialize the message to a line of a JSONL transcript.
+
+        Returns:
+            bytes: Compact JSON of the message, terminated by a newline.
+        """
+        # Serialize straight to bytes, skipping the str round trip of model_dump_json
+        return self.__pydantic_serializer__.to_json(self) + b"\n"
+
+    @staticmethod
+    def construct_from_json(json_data: str | bytes) -> Message:
+        """
+        Create a message from JSON written by `dump_json_line` without validating it.
+        Only use on trusted data, as malformed input is not detected.
+
+        Args:
+            json_data (str | bytes): The JSON-serialized message.
+
+        Returns:
+            Message: The message object.
+        """
+        if _structs is not None:
+            return Message._from_struct(_structs.MESSAGE_DECODER.decode(json_data))
+
+        data = _json_loads(json_data)
+        content: list[ContentTextMessage | ContentImageMessage] = []
+        for content_data in data["content"]:
+            if content_data["type"] == "image":
+                # The validator wrapping the image is skipped by model_construct
+                image = files.LazyImage(content_data.pop("image"))
+                content.append(ContentImageMessage.model_construct(image=image, **content_data))
+            else:
+                content.append(ContentTextMessage.model_construct(**content_data))
+        return Message.model_construct(
+            role=data["role"], content=content, created_at=datetime.fromisoformat(data["created_at"])
+        )
+
+    @staticmethod
+    def _from_struct(message_struct: _structs.MessageStruct) -> Message:
+        content: list[ContentTextMessage | ContentImageMessage] = [
+            ContentImageMessage.model_construct(image=files.LazyImage(content.image), mime=content.mime)
+            if isinstance(content, _structs.ContentImageStruct)
+            else ContentTextMessage.model_construct(text=content.text)
+            for content in message_struct.content
+        ]
+        return Message.model_construct(role=message_struct.role, content=content, created_at=message_struct.created_at)
 
 
 class Conversation(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     messages: list[Message]
 
+    @staticmethod
+    def load_from_path(file_path: str | Path, trust: bool = False) -> Conversation:
+        """
+        Load a conversation from a JSONL transcript. Messages are parsed one line at a time.
+
+        Args:
+            file_path (str | Path): Path to the JSONL transcript.
+            trust (bool): Skip validation of the messages, for transcripts written by this program.
+                Defaults to False.
+
+        Returns:
+            Conversation: The conversation object.
+        """
+        if trust and _structs is not None:
+            # Decode all lines in one call
+            with open(Path(file_path).expanduser(), "rb") as f:
+                message_structs = _structs.MESSAGE_DECODER.decode_lines(f.read())
+            return Conversation.model_construct(messages=[Message._from_struct(m) for m in message_structs])
+
+        parse = Message.construct_from_json if trust else Message.model_validate_json
+        messages: list[Message] = []
+        with open(Path(file_path).expanduser(), "rb") as f:
+            for line in f:
+                if line.strip():
+                    messages.append(parse(line))
+        return Conversation.model_construct(messages=messages) if trust else Conversation(messages=messages)
+
+    def save_to_path(self, file_path: str | Path) -> None:
+        """
+        Save the conversation to a JSONL transcript, one message per line. Overwrites the file atomically.
+
+        Args:
+            file_path (str | Path): Path to the JSONL transcript.
+        """
+        with files.open_atomic(Path(file_path).expanduser()) as f:
+            for message in self.messages:
+                f.write(message.dump_json_line())
+
 
 class ChatSession(BaseModel):
+    """
+    A chat session is saved as two files:
+    - `<name>.json` with the metadata of the session (llm name and kwargs),
+    - `<name>.jsonl` with the transcript of the conversation, one message per line.
+
+    Once saved, new messages are appended to the transcript instead of rewriting it.
+    Alternatively, a chat session is saved as a single `<name>.msgpack` file, rewritten on every save.
+    """
+
+    model_config = ConfigDict(defer_build=True)
+
     llm_name: str
     llm_kwargs: dict
     conv: Conversation
 
+    # Transcript this session was last saved to, and how many messages of `_saved_conv` it holds
+    _transcript_path: Path | None = PrivateAttr(default=None)
+    _saved_conv: Conversation | None = PrivateAttr(default=None)
+    _num_saved_messages: int = PrivateAttr(default=0)
+    # Identity of the transcript file after the last write, see `_file_identity`
+    _transcript_identity: tuple[int, int, int] | None = PrivateAttr(default=None)
+
     @staticmethod
-    def load_from_path(file_path: str) -> ChatSession:
+    def load_from_path(file_path: str | Path, trust: bool = False) -> ChatSession:
         """
-        Load a chat from a JSON file.
+        Load a chat from a JSON metadata file and its JSONL transcript.
+        Legacy chats saved as a single JSON file are also supported.
 
         Args:
-            file_path (str): Path to the JSON file.
+            file_path (str | Path): Path to the JSON file.
+            trust (bool): Skip validation of the transcript if it was written in the current `SCHEMA_VERSION`.
+                Defaults to False.
 
         Returns:
             Chat: The chat object.
         """
-        with open(Path(file_path).expanduser(), "r") as f:
-            data = json.load(f)
+        path = Path(file_path).expanduser()
+        if path.suffix == MSGPACK_SUFFIX:
+            return ChatSession._load_from_msgpack(path)
+        if path.suffix == TRANSCRIPT_SUFFIX:
+            raise ValueError(
+                f"Chats are loaded from their metadata file, not their {TRANSCRIPT_SUFFIX} transcript: {file_path}"
+            )
+        data = _json_loads(path.read_bytes())
+
+        if "conv" in data:
+            # Legacy format with the messages embedded in the JSON file
+            return ChatSession.model_validate(data)
+
+        transcript_path = path.with_suffix(TRANSCRIPT_SUFFIX)
+        is_current_schema = data.pop("schema_version", None) == SCHEMA_VERSION
+        conv = Conversation.load_from_path(transcript_path, trust=trust and is_current_schema)
+        chat_session = ChatSession(conv=conv, **data)
+        if is_current_schema:
+            # Otherwise the next save rewrites the transcript in the current schema instead of appending to it
+            chat_session._mark_saved(transcript_path)
+        return chat_session
+
+    def save_to_path(self, file_path: str | Path) -> None:
+        """
+        Save the chat to a JSON file, and its messages to a JSONL transcript next to it.
+        If the chat was already saved to this path, only the new messages are appended to the transcript.
+
+        Args:
+            file_path (str | Path): Path to the JSON file.
+        """
+        path = Path(file_path).expanduser()
+        if path.suffix == MSGPACK_SUFFIX:
+            self._save_to_msgpack(path)
+            return
+        if path.suffix == TRANSCRIPT_SUFFIX:
+            raise ValueError(f"Chat metadata file cannot have the transcript suffix {TRANSCRIPT_SUFFIX}: {file_path}")
+
+        transcript_path = path.with_suffix(TRANSCRIPT_SUFFIX)
+        if not (self._can_append_to(transcript_path) and self._append_unsaved_messages()):
+            self.conv.save_to_path(transcript_path)
+            self._mark_saved(transcript_path)
+
+        metadata = {"schema_version": SCHEMA_VERSION, **self.model_dump(mode="json", exclude={"conv"})}
+        with files.open_atomic(path) as f:
+            f.write(_json_dumps(metadata))
 
-        # TODO: Currently images that are deep-down in pydantic model are parsed
-        # in the top-level ChatSession. As ChatSession becomes more complex, this
-        # will be hard and unintuitive to maintain.
-        # Is there a way to recursively call parsers on the sub-pydantic models?
+    @staticmethod
+    def _load_from_msgpack(path: Path) -> ChatSession:
+        if _structs is None:
+            raise ValueError(f"Loading {MSGPACK_SUFFIX} chats requires msgspec.")
+        session_struct = _structs.CHAT_SESSION_MSGPACK_DECODER.decode(path.read_bytes())
+        if session_struct.schema_version != SCHEMA_VERSION:
+            raise ValueError(f"Unsupported schema version {session_struct.schema_version} of chat: {path}")
 
-        # Loop through the messages and deserialize the content
-        for i, message in enumerate(data["conv"]["messages"]):
-            for j, content in enumerate(message["content"]):
-                if content["type"] == "image":
-                    data["conv"]["messages"][i]["content"][j]["image"] = files.base64_to_pil(content["image"])
+        messages: list[Message] = []
+        for message_struct in session_struct.messages:
+            content: list[ContentTextMessage | ContentImageMessage] = []
+            for content_struct in message_struct.content:
+                if isinstance(content_struct, _structs.ContentImageBytesStruct):
+                    # Opening only reads the header, the image is decoded when it is first used
+                    image = Image.open(io.BytesIO(content_struct.image))
+                    content.append(
+                        ContentImageMessage(image=image, original_bytes=content_struct.image, mime=content_struct.mime)
+                    )
+                else:
+                    content.append(ContentTextMessage(text=content_struct.text))
+            messages.append(Message(role=message_struct.role, content=content, created_at=message_struct.created_at))
+        return ChatSession(
+            llm_name=session_struct.llm_name,
+            llm_kwargs=session_struct.llm_kwargs,
+            conv=Conversation(messages=messages),
+        )
 
-        return ChatSession(**data)
+    def _save_to_msgpack(self, path: Path) -> None:
+        if _structs is None:
+            raise ValueError(f"Saving {MSGPACK_SUFFIX} chats requires msgspec.")
+        encoder = _structs.CHAT_SESSION_MSGPACK_ENCODER
+        fields = {"schema_version": SCHEMA_VERSION, "llm_name": self.llm_name, "llm_kwargs": self.llm_kwargs}
+        # Write the fields of a `ChatSessionStruct` one by one, and its messages one at a time, so that only
+        # one encoded message is held in memory instead of the whole encoded chat
+        buffer = bytearray()
+        with files.open_atomic(path) as f:
+            f.write(_structs.msgpack_header("map", len(fields) + 1))
+            for name, value in fields.items():
+                f.write(encoder.encode(name) + encoder.encode(value))
+            f.write(encoder.encode("messages") + _structs.msgpack_header("array", len(self.conv.messages)))
+            for message in self.conv.messages:
+                content_structs: list[_structs.ContentTextStruct | _structs.ContentImageBytesStruct] = []
+                for content in message.content:
+                    if isinstance(content, ContentImageMessage):
+                        image_bytes, mime = content.to_bytes()
+                        content_structs.append(_structs.ContentImageBytesStruct(image=image_bytes, mime=mime))
+                    else:
+                        content_structs.append(_structs.ContentTextStruct(text=content.text))
+                message_struct = _structs.BinaryMessageStruct(
+                    role=message.role, content=content_structs, created_at=message.created_at
+                )
+                # Reuse the buffer across messages instead of allocating bytes for each
+                encoder.encode_into(message_struct, buffer)
+                f.write(buffer)
 
-    def save_to_path(self, file_path: str) -> None:
+    def append_message(self, message: Message) -> None:
         """
-        Save the chat to a JSON file.
+        Add a message to the conversation.
+        If the chat has been saved, the message is also appended to its transcript, unless the transcript changed
+        since it was written, in which case the next save rewrites it.
 
         Args:
-            file_path (str): Path to the JSON file.
+            message (Message): The new message.
+        """
+        self.conv.messages.append(message)
+        if self._transcript_path is not None and self._can_append_to(self._transcript_path):
+            self._append_unsaved_messages()
+
+    @staticmethod
+    def _file_identity(stat_result: os.stat_result) -> tuple[int, int, int]:
+        # Changes when the file is replaced, or written to by anyone else
+        return stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+    def _can_append_to(self, transcript_path: Path) -> bool:
+        # The transcript on disk must be a prefix of the current conversation, and unchanged since it was written
+        if not (
+            self._transcript_path == transcript_path
+            and self._saved_conv is self.conv
+            and self._num_saved_messages <= len(self.conv.messages)
+        ):
+            return False
+        try:
+            return self._file_identity(os.stat(transcript_path)) == self._transcript_identity
+        except FileNotFoundError:
+            return False
+
+    def _mark_saved(self, transcript_path: Path) -> None:
+        self._transcript_path = transcript_path
+        self._saved_conv = self.conv
+        self._num_saved_messages = len(self.conv.messages)
+        self._transcript_identity = self._file_identity(os.stat(transcript_path))
+
+    def _append_unsaved_messages(self) -> bool:
+        """
+        Append the messages not saved yet to the transcript.
+
+        Returns:
+            bool: Whether they were appended. They are not if the transcript changed since it was last written,
+                in which case it must be rewritten.
         """
-        with open(Path(file_path).expanduser(), "w") as f:
-            f.write(self.model_dump_json(indent=2))
+        assert self._transcript_path is not None, "Chat has not been saved yet."
+        with open(self._transcript_path, "ab", buffering=files.WRITE_BUFFER_SIZE) as f:
+            # Lock so that lines appended by concurrent writers do not interleave
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Check again under the lock, in case another writer changed the transcript since it was checked
+            if self._file_identity(os.fstat(f.fileno())) != self._transcript_identity:
+                self._transcript_identity = None
+                return False
+            for message in self.conv.messages[self._num_saved_messages :]:
+                f.write(message.dump_json_line())
+            f.flush()
+            self._transcript_identity = self._file_identity(os.fstat(f.fileno()))
+        self._num_saved_messages = len(self.conv.messages)
+        return True
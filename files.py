@@ -1,14 +1,139 @@
-import base64
+import contextlib
 import io
+import os
+import secrets
+import stat
+import weakref
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO
 
 from PIL import Image
 
+try:
+    # SIMD-accelerated base64 codec
+    import pybase64 as base64
 
-def pil_to_base64(image: Image.Image) -> str:
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    # Encodes straight into a str, without an intermediate bytes object to decode
+    _b64encode_to_str = base64.b64encode_as_string
+except ImportError:
+    import base64
+
+    def _b64encode_to_str(data) -> str:
+        return base64.b64encode(data).decode("ascii")
+
+
+# Buffer size for writing chat files, large enough to write base64 images in few syscalls
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+class LazyImage:
+    """
+    A base64-encoded image, decoded into a PIL image only when `load` is first called.
+    Images restored from transcripts are kept this way so that ones that are never displayed or sent
+    to a vision model are never decoded, and are re-serialized without re-encoding.
+    """
+
+    __slots__ = ("base64_image", "_image")
+
+    def __init__(self, base64_image: str):
+        self.base64_image = base64_image
+        self._image: Image.Image | None = None
+
+    def load(self) -> Image.Image:
+        if self._image is None:
+            self._image = base64_to_pil(self.base64_image)
+        return self._image
+
+
+def to_pil(image: Image.Image | LazyImage) -> Image.Image:
+    return image.load() if isinstance(image, LazyImage) else image
+
+
+# Base64 encodings of images keyed by id(image), so that each image is encoded only once per process.
+# Entries are dropped when their image is garbage collected, before its id can be reused.
+# Images are assumed not to be modified in place after they are first encoded.
+_base64_cache: dict[int, str] = {}
+
+
+def pil_to_base64(image: Image.Image | LazyImage) -> str:
+    if isinstance(image, LazyImage):
+        return image.base64_image
+
+    key = id(image)
+    if (image_base64 := _base64_cache.get(key)) is not None:
+        return image_base64
+
+    with io.BytesIO() as buffered:
+        image.save(buffered, format="JPEG")
+        # Encode a view of the buffer instead of a copy of it. The view is released before the buffer is closed
+        with buffered.getbuffer() as jpeg_bytes:
+            image_base64 = _b64encode_to_str(jpeg_bytes)
+
+    _base64_cache[key] = image_base64
+    weakref.finalize(image, _base64_cache.pop, key, None)
+    return image_base64
+
+
+def pil_to_base64_many(images: Sequence[Image.Image | LazyImage]) -> list[str]:
+    """
+    Encode images to base64 like `pil_to_base64`, encoding the ones not cached yet concurrently.
+    JPEG encoding releases the GIL, so threads encode on multiple cores.
+
+    Args:
+        images (Sequence[Image.Image | LazyImage]): Images to encode.
+
+    Returns:
+        list[str]: Base64 encodings, in the order of `images`.
+    """
+    uncached_images = {
+        id(image): image for image in images if not isinstance(image, LazyImage) and id(image) not in _base64_cache
+    }
+    if len(uncached_images) > 1:
+        with ThreadPoolExecutor(max_workers=min(8, len(uncached_images), os.cpu_count() or 1)) as executor:
+            # Fills the cache
+            list(executor.map(pil_to_base64, uncached_images.values()))
+    return [pil_to_base64(image) for image in images]
 
 
 def base64_to_pil(base64_image: str) -> Image.Image:
-    return Image.open(io.BytesIO(base64.b64decode(base64_image)))
+    return Image.open(io.BytesIO(base64.b64decode(base64_image, validate=False)))
+
+
+def base64_to_bytes(base64_image: str) -> bytes:
+    return base64.b64decode(base64_image, validate=False)
+
+
+def bytes_to_base64(data: bytes) -> str:
+    return _b64encode_to_str(data)
+
+
+@contextlib.contextmanager
+def open_atomic(path: Path) -> Iterator[BinaryIO]:
+    """
+    Open a temporary binary file next to `path` for writing, and move it over `path` once writing succeeds.
+    Readers never see a partially written file.
+
+    Args:
+        path (Path): Destination path.
+    """
+    try:
+        replaced_mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        replaced_mode = None
+    # Created like `open` creates files, so that new files get the permissions allowed by the umask
+    tmp_path = path.with_name(f".{path.name}.{secrets.token_hex(8)}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+            if replaced_mode is not None:
+                # Keep the permissions of the file being replaced
+                os.fchmod(f.fileno(), replaced_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
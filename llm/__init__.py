@@ -7,35 +7,24 @@ from llm.openai import OpenAIChat
 from llm.together import TogetherChat
 from llm.vllm import VLLMChat
 
-SUPPORTED_LLM_SERVERS = [
-    "anthropic",
-    "gemini",
-    "hf-llama",
-    "ollama",
-    "openai",
-    "together",
-    "vllm",
-]
+_LLM_CHATS: dict[str, type[LLMChat]] = {
+    "anthropic": AnthropicChat,
+    "gemini": GeminiChat,
+    "hf-llama": HFLlamaChat,
+    "ollama": OllamaChat,
+    "openai": OpenAIChat,
+    "together": TogetherChat,
+    "vllm": VLLMChat,
+}
+
+SUPPORTED_LLM_SERVERS = list(_LLM_CHATS)
 
 
 def get_llm(server: str, model_name: str, model_kwargs: dict) -> LLMChat:
-    match server:
-        case "anthropic":
-            return AnthropicChat(model_name=model_name, **model_kwargs)
-        case "gemini":
-            return GeminiChat(model_name=model_name, **model_kwargs)
-        case "hf-llama":
-            # Huggingface Llama models do not support temperature=0, so we set it to 0.01 or higher
-            if "temperature" in model_kwargs:
-                model_kwargs["temperature"] = max(0.01, model_kwargs["temperature"])
-            return HFLlamaChat(model_name=model_name, **model_kwargs)
-        case "ollama":
-            return OllamaChat(model_name=model_name, **model_kwargs)
-        case "openai":
-            return OpenAIChat(model_name=model_name, **model_kwargs)
-        case "together":
-            return TogetherChat(model_name=model_name, **model_kwargs)
-        case "vllm":
-            return VLLMChat(model_name=model_name, **model_kwargs)
-        case _:
-            raise ValueError(f"Provider {server} not supported.")
+    llm_chat_cls = _LLM_CHATS.get(server)
+    if llm_chat_cls is None:
+        raise ValueError(f"Provider {server} not supported.")
+    if llm_chat_cls is HFLlamaChat and "temperature" in model_kwargs:
+        # Huggingface Llama models do not support temperature=0, so we set it to 0.01 or higher
+        model_kwargs["temperature"] = max(0.01, model_kwargs["temperature"])
+    return llm_chat_cls(model_name=model_name, **model_kwargs)
@@ -2,10 +2,14 @@ import os
 
 import anthropic
 
+from llm import _http
 from llm.common import CommonLLMChat
 
 
 class AnthropicChat(CommonLLMChat):
+    RETRYABLE_EXCEPTIONS = (anthropic.RateLimitError,)
+    _native_retries = True
+
     def __init__(
         self,
         model_name: str,
@@ -13,14 +17,27 @@ class AnthropicChat(CommonLLMChat):
         max_tokens: int = 4096,
         temperature: float = 0.0,
         seed: int = 0,
+        max_retries: int = 3,
+        wait_seconds: float = 1.0,
     ):
         """
         Examples of model names:
             "claude-3-5-haiku-20241022"
             "claude-3-5-sonnet-20241022"
         """
-        super().__init__(model_name, model_path, max_tokens, temperature, seed)
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        super().__init__(model_name, model_path, max_tokens, temperature, seed, max_retries, wait_seconds)
+        self.client = anthropic.Anthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            max_retries=self.max_retries,
+            timeout=_http.TIMEOUT,
+            http_client=_http.HTTP_CLIENT,
+        )
+        self.aclient = anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            max_retries=self.max_retries,
+            timeout=_http.TIMEOUT,
+            http_client=_http.ASYNC_HTTP_CLIENT,
+        )
 
     @staticmethod
     def is_model_supported(model_name: str) -> bool:
@@ -35,3 +52,12 @@ class AnthropicChat(CommonLLMChat):
             temperature=self.temperature,
         )
         return response.content[0].text
+
+    async def _acall_api(self, messages_api_format: list[dict]) -> str:
+        response = await self.aclient.messages.create(
+            model=self.model_name,
+            messages=messages_api_format,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        return response.content[0].text
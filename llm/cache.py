@@ -0,0 +1,221 @@
+import hashlib
+import json
+import pickle
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+
+import files
+from _types import ContentImageMessage, Conversation
+from llm.common import CommonLLMChat
+
+try:
+    import hnswlib
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # Without them, only exact matches are served from the cache
+    hnswlib = None
+    SentenceTransformer = None
+
+
+# Number of nearest cached texts checked for a semantic hit, since the nearest may follow other messages
+_SEMANTIC_CANDIDATES = 8
+
+
+@cache
+def _load_embedder(model_name: str) -> "SentenceTransformer":
+    return SentenceTransformer(model_name)
+
+
+@dataclass
+class _CacheEntry:
+    response: str
+    created_at: float
+    label: int | None = None  # Label of the embedded user text in the index, if any
+    prefix_key: str | None = None  # Key of the messages before the embedded user text, if any
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        threshold: float = 0.05,
+        max_entries: int = 1024,
+        ttl_seconds: float | None = None,
+        embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+    ):
+        """
+        In-process cache of LLM responses. A conversation is a hit if its API-formatted messages are identical
+        to a cached one, or, if `hnswlib` and `sentence-transformers` are installed, if its last user message
+        is within `threshold` cosine distance of a cached conversation's last user message, after identical
+        previous messages. Conversations with images are only exact hits. Hits must also have been generated by
+        the same model with the same sampling settings.
+
+        Args:
+            threshold (float): Maximum cosine distance between the last user messages of a semantic hit.
+                Defaults to 0.05.
+            max_entries (int): Maximum number of cached responses; the least recently used are evicted first.
+                Defaults to 1024.
+            ttl_seconds (Optional[float]): Responses older than this are evicted. None keeps them forever.
+                Defaults to None.
+            embedding_model (str): Sentence Transformers model that embeds the last user message.
+                Defaults to "sentence-transformers/all-MiniLM-L6-v2".
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.embedding_model = embedding_model
+
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self._label_to_key: dict[int, str] = {}
+        self._next_label = 0
+        self._index = None  # Created on the first embedding, once its dimension is known
+
+    @property
+    def is_semantic(self) -> bool:
+        return hnswlib is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _key(llm_chat: CommonLLMChat, messages_api_format: list[dict]) -> str:
+        # Responses of other models or sampling settings are not interchangeable, e.g. in a cache loaded from disk
+        settings = [llm_chat.model_name, llm_chat.temperature, llm_chat.max_tokens, llm_chat.seed]
+        return hashlib.sha256(json.dumps([settings, messages_api_format], sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def _semantic_key(
+        cls, llm_chat: CommonLLMChat, conv: Conversation, messages_api_format: list[dict]
+    ) -> tuple[str, str] | None:
+        """
+        Key of the messages before the last user message, and the text of the last user message, which is
+        embedded for semantic lookups. None if the conversation cannot be a semantic hit: when it has images,
+        which are not embedded, or does not end with a user text.
+        """
+        if not conv.messages or conv.messages[-1].role != "user":
+            return None
+        if any(isinstance(content, ContentImageMessage) for message in conv.messages for content in message.content):
+            return None
+        user_text = "\n".join(content.text for content in conv.messages[-1].content)
+        if not user_text:
+            return None
+        # The last user message is the last API entry, since it has text
+        return cls._key(llm_chat, messages_api_format[:-1]), user_text
+
+    def _embed(self, text: str):
+        return _load_embedder(self.embedding_model).encode([text], normalize_embeddings=True)
+
+    def _evict(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        if entry.label is not None:
+            self._index.mark_deleted(entry.label)
+            del self._label_to_key[entry.label]
+
+    def _is_expired(self, entry: _CacheEntry) -> bool:
+        return self.ttl_seconds is not None and time.time() - entry.created_at > self.ttl_seconds
+
+    def _get(self, key: str) -> str | None:
+        # Entries are ordered by recency of use, not creation, so expired ones are evicted when they are found
+        entry = self._entries[key]
+        if self._is_expired(entry):
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.response
+
+    def _lookup(self, key: str, semantic_key: tuple[str, str] | None) -> str | None:
+        if key in self._entries and (response := self._get(key)) is not None:
+            return response
+
+        if not self.is_semantic or semantic_key is None or not self._label_to_key:
+            return None
+        prefix_key, user_text = semantic_key
+        k = min(_SEMANTIC_CANDIDATES, len(self._label_to_key))
+        labels, distances = self._index.knn_query(self._embed(user_text), k=k)
+        for label, distance in zip(labels[0], distances[0]):
+            if distance >= self.threshold:
+                break
+            candidate_key = self._label_to_key.get(int(label))
+            # Only texts asked after the same previous messages are answered the same
+            if candidate_key is None or self._entries[candidate_key].prefix_key != prefix_key:
+                continue
+            if (response := self._get(candidate_key)) is not None:
+                return response
+        return None
+
+    def _insert(self, key: str, semantic_key: tuple[str, str] | None, response: str) -> None:
+        if key in self._entries:
+            self._evict(key)
+        while len(self._entries) >= self.max_entries:
+            self._evict(next(iter(self._entries)))
+
+        entry = _CacheEntry(response=response, created_at=time.time())
+        if self.is_semantic and semantic_key is not None:
+            entry.prefix_key, user_text = semantic_key
+            vector = self._embed(user_text)
+            if self._index is None:
+                self._index = hnswlib.Index(space="cosine", dim=vector.shape[1])
+                self._index.init_index(max_elements=self.max_entries, allow_replace_deleted=True)
+            entry.label = self._next_label
+            self._next_label += 1
+            # Evicted entries free their slots in the index, so it never grows past `max_entries`
+            self._index.add_items(vector, [entry.label], replace_deleted=True)
+            self._label_to_key[entry.label] = key
+        self._entries[key] = entry
+
+    def wrap(self, llm_chat: CommonLLMChat) -> CommonLLMChat:
+        """
+        Patch `llm_chat.generate_response` and `llm_chat.agenerate_response`, and so `agenerate_many`,
+        to serve responses from this cache, and to cache responses on misses.
+
+        Args:
+            llm_chat (CommonLLMChat): The LLM chat object to patch.
+
+        Returns:
+            CommonLLMChat: The same, patched, LLM chat object.
+        """
+
+        def generate_response(conv: Conversation) -> str:
+            assert llm_chat.client is not None, "Client is not initialized."
+
+            messages_api_format = llm_chat._convert_conv_to_api_format(conv)
+            key = self._key(llm_chat, messages_api_format)
+            semantic_key = self._semantic_key(llm_chat, conv, messages_api_format)
+            response = self._lookup(key, semantic_key)
+            if response is None:
+                response = llm_chat._call_api_with_retries(messages_api_format)
+                self._insert(key, semantic_key, response)
+            return response
+
+        async def agenerate_response(conv: Conversation) -> str:
+            assert llm_chat.aclient is not None, "Async client is not initialized."
+
+            messages_api_format = llm_chat._convert_conv_to_api_format(conv)
+            key = self._key(llm_chat, messages_api_format)
+            semantic_key = self._semantic_key(llm_chat, conv, messages_api_format)
+            # Lookups and inserts do not await, so concurrent calls never see the cache half updated
+            response = self._lookup(key, semantic_key)
+            if response is None:
+                response = await llm_chat._acall_api_with_retries(messages_api_format)
+                self._insert(key, semantic_key, response)
+            return response
+
+        llm_chat.generate_response = generate_response
+        llm_chat.agenerate_response = agenerate_response
+        return llm_chat
+
+    def save_to_path(self, file_path: str | Path) -> None:
+        """
+        Pickle the cache, including its index, to the file path.
+        """
+        with files.open_atomic(Path(file_path)) as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load_from_path(file_path: str | Path) -> "SemanticCache":
+        """
+        Load a cache pickled with `save_to_path`. Only load caches you saved yourself.
+        """
+        with open(file_path, "rb") as f:
+            return pickle.load(f)
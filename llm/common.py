@@ -1,7 +1,12 @@
 import abc
+import asyncio
+import weakref
+from collections.abc import Callable, Iterator, Sequence
+
+from tenacity import AsyncRetrying, Retrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 import files
-from _types import ContentImageMessage, ContentTextMessage, Conversation
+from _types import ContentImageMessage, ContentTextMessage, Conversation, Message
 
 
 class LLMChat(abc.ABC):
@@ -53,8 +58,44 @@ class LLMChat(abc.ABC):
         """
         pass
 
+    def generate_response_stream(self, conv: Conversation) -> Iterator[str]:
+        """
+        Generate a response for the conversation, yielding it in chunks as it is generated.
+        Models that do not support streaming yield the whole response at once.
+
+        Args:
+            conv (Conversation): The conversation object.
+
+        Yields:
+            str: The next chunk of the response generated by the model.
+        """
+        yield self.generate_response(conv)
+
+
+def _format_text(content: ContentTextMessage) -> dict:
+    return {"type": "text", "text": content.text}
+
+
+def _format_image(content: ContentImageMessage) -> dict:
+    base64_image, mime = content.to_base64()
+    return {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{base64_image}"}}
+
+
+# Formatters of each content type into a part of an API message. A dict lookup on the exact type
+# is cheaper than matching each content against class patterns
+_CONTENT_FORMATTERS: dict[type, Callable[..., dict]] = {
+    ContentTextMessage: _format_text,
+    ContentImageMessage: _format_image,
+}
+
 
 class CommonLLMChat(LLMChat):
+    # Exceptions raised by the client on which API calls are retried, e.g. rate limit errors
+    RETRYABLE_EXCEPTIONS: tuple[type[Exception], ...] = ()
+    # Whether the clients retry failed API calls themselves, given `max_retries`. Their backoff respects the
+    # Retry-After headers of rate limited responses, so API calls are not wrapped in `Retrying` as well
+    _native_retries: bool = False
+
     def __init__(
         self,
         model_name: str,
@@ -62,9 +103,40 @@ class CommonLLMChat(LLMChat):
         max_tokens: int = 4096,
         temperature: float = 0.0,
         seed: int = 0,
+        max_retries: int = 3,
+        wait_seconds: float = 1.0,
     ):
+        """
+        Initialize the LLM chat object that calls an API provider. See `LLMChat` for the other arguments.
+
+        Args:
+            max_retries (int): Maximum number of retries of an API call that raised a retryable exception.
+                Defaults to 3.
+            wait_seconds (float): Initial wait before retrying, doubled (with jitter) on every retry up to 60s.
+                Not used by clients with native retries. Defaults to 1.0.
+        """
         super().__init__(model_name, model_path, max_tokens, temperature, seed)
         self.client = None
+        self.aclient = None
+        self.max_retries = max_retries
+        self.wait_seconds = wait_seconds
+        # Conversation id -> (number of formatted messages, last formatted message, formatted messages)
+        self._formatted_prefixes: dict[int, tuple[int, Message | None, list[dict]]] = {}
+
+        # Reused by every `generate_response`. Unlike the `@retry` decorator, calling a `Retrying` object directly
+        # does not copy it on every call, and its per-call state is thread-local.
+        self._retrying = Retrying(
+            stop=stop_after_attempt(max_retries + 1),
+            wait=wait_exponential_jitter(initial=wait_seconds, max=60),
+            retry=retry_if_exception_type(self.RETRYABLE_EXCEPTIONS),
+            reraise=True,
+        )
+        self._async_retrying = AsyncRetrying(
+            stop=stop_after_attempt(max_retries + 1),
+            wait=wait_exponential_jitter(initial=wait_seconds, max=60),
+            retry=retry_if_exception_type(self.RETRYABLE_EXCEPTIONS),
+            reraise=True,
+        )
 
     @abc.abstractmethod
     def _call_api(self, messages_api_format: list[dict]) -> str:
@@ -74,38 +146,83 @@ class CommonLLMChat(LLMChat):
         """
         pass
 
-    def _convert_conv_to_api_format(self, conv: Conversation) -> list[dict]:
+    @abc.abstractmethod
+    async def _acall_api(self, messages_api_format: list[dict]) -> str:
+        """
+        Async version of `_call_api` that uses the async client.
+        """
+        pass
+
+    def _call_api_with_retries(self, messages_api_format: list[dict]) -> str:
+        """
+        Call the API, retrying on retryable exceptions unless the client retries them itself.
         """
-        Converts the conversation object to a common format supported by various LLM providers.
+        if self._native_retries:
+            return self._call_api(messages_api_format)
+        return self._retrying(self._call_api, messages_api_format)
+
+    async def _acall_api_with_retries(self, messages_api_format: list[dict]) -> str:
+        """
+        Async version of `_call_api_with_retries`.
+        """
+        if self._native_retries:
+            return await self._acall_api(messages_api_format)
+        return await self._async_retrying(self._acall_api, messages_api_format)
+
+    def _convert_message_to_api_format(self, message: Message) -> list[dict]:
+        """
+        Converts one message to entries of a common format supported by various LLM providers.
+        Each message becomes one entry holding all of its content parts, or none if it has no parts.
         Common format is:
         ```
         [
-            {"role": role1, "content": [{"type": "text", "text": text1},
-            {"role": role2, "content": [{"type": "text", "text": text2},
-            {"role": role3, "content": [{"type": "text", "text": text3},
+            {"role": role1, "content": [{"type": "text", "text": text1}]},
+            {"role": role2, "content": [{"type": "text", "text": text2}, {"type": "image_url", ...}]},
+            {"role": role3, "content": [{"type": "text", "text": text3}]},
         ]
         ```
         """
-        formatted_messages = []
-        for message in conv.messages:
-            for content in message.content:
-                match content:
-                    case ContentTextMessage(text=text):
-                        formatted_messages.append({"role": message.role, "content": [{"type": "text", "text": text}]})
-                    case ContentImageMessage(image=image):
-                        base64_image = files.pil_to_base64(image)
-                        formatted_messages.append(
-                            {
-                                "role": message.role,
-                                "content": [
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                                    }
-                                ],
-                            }
-                        )
-        return formatted_messages
+        parts = [_CONTENT_FORMATTERS[type(content)](content) for content in message.content]
+        return [{"role": message.role, "content": parts}] if parts else []
+
+    def _convert_conv_to_api_format(self, conv: Conversation) -> list[dict]:
+        """
+        Converts the conversation object to the API format using `_convert_message_to_api_format`.
+
+        The formatted prefix of every conversation is memoized, so a call after new messages were appended only
+        formats the new messages, and the prefix sent to the provider stays byte-identical across turns.
+        The memo of a conversation is dropped when it is garbage collected, or when its formatted messages
+        were removed or replaced. Messages are assumed not to be edited in place.
+        """
+        num_formatted, last_formatted_message, formatted_messages = self._formatted_prefixes.get(
+            id(conv), (0, None, [])
+        )
+        if num_formatted > len(conv.messages) or (
+            num_formatted > 0 and conv.messages[num_formatted - 1] is not last_formatted_message
+        ):
+            num_formatted, formatted_messages = 0, []
+        new_messages = conv.messages[num_formatted:]
+        if not new_messages and id(conv) in self._formatted_prefixes:
+            return formatted_messages.copy()
+
+        # Encode all new images without original bytes up front, so that multiple new images are encoded concurrently
+        files.pil_to_base64_many(
+            [
+                content.image
+                for message in new_messages
+                for content in message.content
+                if type(content) is ContentImageMessage and content.original_bytes is None
+            ]
+        )
+        for message in new_messages:
+            formatted_messages.extend(self._convert_message_to_api_format(message))
+
+        if id(conv) not in self._formatted_prefixes:
+            weakref.finalize(conv, self._formatted_prefixes.pop, id(conv), None)
+        last_message = conv.messages[-1] if conv.messages else None
+        self._formatted_prefixes[id(conv)] = (len(conv.messages), last_message, formatted_messages)
+        # Return a copy so that the caller cannot change the memoized prefix
+        return formatted_messages.copy()
 
     def generate_response(self, conv: Conversation) -> str:
         """
@@ -114,4 +231,36 @@ class CommonLLMChat(LLMChat):
         assert self.client is not None, "Client is not initialized."
 
         messages_api_format: list[dict] = self._convert_conv_to_api_format(conv)
-        return self._call_api(messages_api_format)
+        return self._call_api_with_retries(messages_api_format)
+
+    async def agenerate_response(self, conv: Conversation) -> str:
+        """
+        Generate response for the conversation without blocking the event loop.
+        """
+        assert self.aclient is not None, "Async client is not initialized."
+
+        messages_api_format: list[dict] = self._convert_conv_to_api_format(conv)
+        return await self._acall_api_with_retries(messages_api_format)
+
+    async def agenerate_many(self, convs: Sequence[Conversation], max_concurrency: int = 8) -> list[str]:
+        """
+        Generate responses for many conversations concurrently, overlapping their API round-trips.
+
+        For a local Ollama server, requests beyond its `OLLAMA_NUM_PARALLEL` setting are queued by the server,
+        so set `max_concurrency` no higher than that.
+
+        Args:
+            convs (Sequence[Conversation]): The conversations to respond to.
+            max_concurrency (int): Maximum number of API calls in flight at once.
+                Defaults to 8.
+
+        Returns:
+            list[str]: The responses, in the same order as `convs`.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def generate(conv: Conversation) -> str:
+            async with semaphore:
+                return await self.agenerate_response(conv)
+
+        return await asyncio.gather(*(generate(conv) for conv in convs))
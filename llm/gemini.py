@@ -1,19 +1,20 @@
 import os
 
 import google.generativeai as gemini
+from google.api_core import exceptions as google_exceptions
 
-from _types import ContentTextMessage, Conversation
+from _types import ContentTextMessage, Message
 from llm.common import CommonLLMChat
 
 
 class GeminiChat(CommonLLMChat):
     """
-    Overrides the common messages format with the Gemini format:
+    Overrides the common messages format with the Gemini format, with one entry per message:
     ```
     [
-        {"role": role1, "parts": text1},
-        {"role": role2, "parts": text2},
-        {"role": role3, "parts": text3},
+        {"role": role1, "parts": [text1]},
+        {"role": role2, "parts": [text2, text3]},
+        {"role": role3, "parts": [text4]},
     ]
     ```
 
@@ -23,6 +24,8 @@ class GeminiChat(CommonLLMChat):
         "gemini-2.0-flash-exp"
     """
 
+    RETRYABLE_EXCEPTIONS = (google_exceptions.ResourceExhausted,)
+
     def __init__(
         self,
         model_name: str,
@@ -30,30 +33,47 @@ class GeminiChat(CommonLLMChat):
         max_tokens: int = 4096,
         temperature: float = 0.0,
         seed: int = 0,
+        max_retries: int = 3,
+        wait_seconds: float = 1.0,
     ):
-        super().__init__(model_name, model_path, max_tokens, temperature, seed)
+        super().__init__(model_name, model_path, max_tokens, temperature, seed, max_retries, wait_seconds)
 
         gemini.configure(api_key=os.getenv("GEMINI_API_KEY"))
         self.client = gemini.GenerativeModel(self.model_name)
+        # The same model object also serves async requests through `generate_content_async`
+        self.aclient = self.client
+
+        # Built once and reused by every API call, until the temperature or max tokens change
+        self._generation_config: gemini.types.GenerationConfig | None = None
+        self._generation_config_key: tuple[float, int] | None = None
+
+    def _get_generation_config(self) -> gemini.types.GenerationConfig:
+        key = (self.temperature, self.max_tokens)
+        if key != self._generation_config_key:
+            self._generation_config = gemini.types.GenerationConfig(
+                temperature=self.temperature,
+                max_output_tokens=self.max_tokens,
+            )
+            self._generation_config_key = key
+        return self._generation_config
 
-    def _convert_conv_to_api_format(self, conv: Conversation) -> list[dict]:
+    def _convert_message_to_api_format(self, message: Message) -> list[dict]:
         # https://ai.google.dev/gemini-api/docs/models/gemini
         # https://github.com/google-gemini/generative-ai-python/blob/main/docs/api/google/generativeai/GenerativeModel.md
-        formatted_messages = []
-        for message in conv.messages:
-            for content in message.content:
-                match content:
-                    case ContentTextMessage(text=text):
-                        role = "model" if message.role == "assistant" else message.role
-                        formatted_messages.append({"role": role, "parts": text})
-        return formatted_messages
+        parts = [content.text for content in message.content if type(content) is ContentTextMessage]
+        role = "model" if message.role == "assistant" else message.role
+        return [{"role": role, "parts": parts}] if parts else []
 
     def _call_api(self, messages_api_format: list[dict]) -> str:
         response = self.client.generate_content(
             contents=messages_api_format,
-            generation_config=gemini.types.GenerationConfig(
-                temperature=self.temperature,
-                max_output_tokens=self.max_tokens,
-            ),
+            generation_config=self._get_generation_config(),
+        )
+        return response.text
+
+    async def _acall_api(self, messages_api_format: list[dict]) -> str:
+        response = await self.aclient.generate_content_async(
+            contents=messages_api_format,
+            generation_config=self._get_generation_config(),
         )
         return response.text
@@ -1,10 +1,27 @@
+import threading
+import warnings
+from collections import OrderedDict
+from collections.abc import Iterator
+from typing import Literal
+
 import torch
 from PIL import Image
-from transformers import AutoProcessor, MllamaForConditionalGeneration
+from transformers import (
+    AutoModelForCausalLM,
+    AutoProcessor,
+    BatchFeature,
+    BitsAndBytesConfig,
+    MllamaForConditionalGeneration,
+    TextIteratorStreamer,
+)
 
-from _types import ContentImageMessage, Conversation
+import files
+from _types import ContentImageMessage, ContentTextMessage, Conversation, Message
 from llm.common import LLMChat
 
+# Number of rendered conversation prefixes kept by `HFLlamaChat._apply_chat_template`
+_TEMPLATE_CACHE_SIZE = 8
+
 
 class HFLlamaChat(LLMChat):
     def __init__(
@@ -14,51 +31,284 @@ class HFLlamaChat(LLMChat):
         max_tokens: int = 4096,
         temperature: float = 0.0,
         seed: int = 0,
+        compile_model: bool = False,
+        quantization: Literal["bf16", "int8", "nf4"] = "bf16",
+        draft_model_name: str | None = None,
     ):
         """
         Examples of model names:
             "meta-llama/Llama-3.1-8B-Instruct"
             "meta-llama/Llama-3.2-3B-Instruct"
             "meta-llama/Llama-3.2-11B-Vision-Instruct"
+
+        Args:
+            compile_model (bool): Compile the model's forward pass with `torch.compile`, which reduces per-token
+                Python overhead. Models that support a static KV cache also use one, and replay CUDA graphs during
+                decoding. Other models, e.g. Llama 3.2 Vision, keep the dynamic cache and only get the "default"
+                compile mode, without CUDA graph replay. Loading the model is slower, since it warms up by compiling,
+                and prompts of new lengths may recompile.
+                Defaults to False.
+            quantization (Literal["bf16", "int8", "nf4"]): Precision of the model weights. "int8" and "nf4"
+                quantize them to 8 and 4 bits with bitsandbytes at load time, cutting GPU memory and the weight
+                bandwidth of decoding by ~2x and ~4x respectively. Defaults to "bf16".
+            draft_model_name (Optional[str]): Small model sharing the tokenizer of the model, e.g.
+                "meta-llama/Llama-3.2-1B-Instruct", that drafts tokens for the model to verify in parallel
+                (speculative decoding). Only used for single conversations without images, and the draft model
+                must fit in GPU memory alongside the model. Responses generated with the draft model use a dynamic
+                KV cache, without the static cache speedup of `compile_model`.
+                Defaults to None, for no draft model.
         """
         super().__init__(model_name, model_path, max_tokens, temperature, seed)
-
         # Use local model if provided
         model_path_to_use = self.model_path or self.model_name
+        quantization_config = None
+        if quantization == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        elif quantization == "nf4":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_quant_type="nf4",
+            )
         self.model = MllamaForConditionalGeneration.from_pretrained(
             model_path_to_use,
+            # Also the dtype of the modules that quantization leaves unquantized, e.g. the vision tower and lm_head
             torch_dtype=torch.bfloat16,
             device_map="auto",
+            quantization_config=quantization_config,
         )
+        if compile_model:
+            compile_mode = "default"
+            # Private attribute of transformers models, which may not exist in other versions
+            if getattr(self.model, "_supports_static_cache", False):
+                # A static KV cache keeps tensor shapes fixed across decoding steps, so that CUDA graphs can be replayed
+                self.model.generation_config.cache_implementation = "static"
+                compile_mode = "reduce-overhead"
+            # `generate` calls `forward` once per decoding step, so compile that rather than the module.
+            # Without a static cache, shapes grow every step, so CUDA graphs would be recaptured instead of replayed
+            self.model.forward = torch.compile(self.model.forward, mode=compile_mode, fullgraph=False)
+        self.draft_model = None
+        if draft_model_name is not None:
+            if self.model.generation_config.cache_implementation == "static":
+                warnings.warn(
+                    "Assisted generation with a draft model falls back to a dynamic KV cache, so compile_model does "
+                    "not replay CUDA graphs for responses generated with the draft model.",
+                    stacklevel=2,
+                )
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_name,
+                torch_dtype=torch.bfloat16,
+                device_map=self.model.device,
+            )
         self.processor = AutoProcessor.from_pretrained(model_path_to_use)
+        # Batched generation needs the prompts to be padded on the left
+        self.processor.tokenizer.padding_side = "left"
+        # Stream for copying inputs to the GPU, see `_to_model_device`
+        self._h2d_stream = torch.cuda.Stream(self.model.device) if torch.cuda.is_available() else None
 
-    def generate_response(self, conv: Conversation) -> str:
-        # Take out images from messages
-        images: list[Image.Image] = []
-        for message in conv.messages:
-            for content in message.content:
-                match content:
-                    case ContentImageMessage(image=image):
-                        images.append(image)
-
-        # Process text and images
-        input_text = self.processor.apply_chat_template(conv.messages, add_generation_prompt=True)
+        # Rendered chat templates of conversation prefixes, keyed by `_messages_keys`
+        self._template_cache: OrderedDict[int, str] = OrderedDict()
+        self._template_parts: tuple[str, str] | None = self._split_chat_template()
+
+        if compile_model:
+            self._warm_up()
+
+    def _warm_up(self) -> None:
+        """
+        Generate a few tokens for a dummy conversation, so that compilation and CUDA graph capture happen
+        when the model is loaded rather than during the first response.
+        """
+        conv = Conversation(messages=[Message(role="user", content=[ContentTextMessage(text="Hi")])])
+        inputs = self._prepare_inputs([conv])
+        with torch.inference_mode():
+            self.model.generate(**inputs, temperature=self.temperature, max_new_tokens=2)
+
+    def _assistant_kwargs(self, inputs: BatchFeature) -> dict:
+        """
+        Keyword arguments of `generate` for speculative decoding with the draft model, if it can be used:
+        assisted generation only supports a batch size of 1, and the text-only draft model cannot take images.
+        """
+        if self.draft_model is None or inputs["input_ids"].shape[0] != 1 or "pixel_values" in inputs:
+            return {}
+        return {"assistant_model": self.draft_model}
+
+    def _split_chat_template(self) -> tuple[str, str] | None:
+        """
+        Find the preamble the chat template renders before the first message and the generation prompt it
+        renders after the last one, e.g. "<|begin_of_text|>" and "<|start_header_id|>assistant<|end_header_id|>".
+
+        Returns:
+            tuple[str, str] | None: The preamble and the generation prompt, or None if the template does not
+                render each message independently of the others, in which case it cannot be rendered incrementally.
+        """
+        message = {"role": "user", "content": [{"type": "text", "text": "Hi"}]}
+        try:
+            one = self.processor.apply_chat_template([message])
+            two = self.processor.apply_chat_template([message, message])
+            one_with_prompt = self.processor.apply_chat_template([message], add_generation_prompt=True)
+        except Exception:
+            # E.g. templates that require roles to alternate
+            return None
+        rendered_message = two[len(one) :]
+        if not (two.startswith(one) and one.endswith(rendered_message) and one_with_prompt.startswith(one)):
+            return None
+        return one[: len(one) - len(rendered_message)], one_with_prompt[len(one) :]
+
+    @staticmethod
+    def _messages_keys(messages: list[Message]) -> list[int]:
+        """
+        Rolling hashes of the roles and contents of the conversation prefixes `messages[:k]`, for k = 0..len(messages).
+        Images are identified by their object ids.
+        """
+        keys = [hash(())]
+        for message in messages:
+            content_keys = tuple(
+                content.text if isinstance(content, ContentTextMessage) else id(content.image)
+                for content in message.content
+            )
+            keys.append(hash((keys[-1], message.role, content_keys)))
+        return keys
+
+    def _apply_chat_template(self, messages: list[Message]) -> str:
+        """
+        Render the messages with the chat template, followed by the generation prompt.
+        The longest already rendered prefix of the messages is reused from the cache, so that each turn
+        only renders the messages added since the previous one.
+        """
+        if self._template_parts is None:
+            return self.processor.apply_chat_template(messages, add_generation_prompt=True)
+        preamble, generation_prompt = self._template_parts
+
+        keys = self._messages_keys(messages)
+        num_cached, rendered = 0, ""
+        for k in range(len(messages) - 1, 0, -1):
+            if (cached := self._template_cache.get(keys[k])) is not None:
+                num_cached, rendered = k, cached
+                self._template_cache.move_to_end(keys[k])
+                break
+
+        rendered_new = self.processor.apply_chat_template(messages[num_cached:])
+        if num_cached > 0:
+            if not rendered_new.startswith(preamble):
+                # The preamble changed, e.g. templates that render the current date
+                self._template_cache.clear()
+                return self.processor.apply_chat_template(messages, add_generation_prompt=True)
+            rendered_new = rendered_new[len(preamble) :]
+        rendered += rendered_new
+
+        self._template_cache[keys[-1]] = rendered
+        self._template_cache.move_to_end(keys[-1])
+        if len(self._template_cache) > _TEMPLATE_CACHE_SIZE:
+            self._template_cache.popitem(last=False)
+        return rendered + generation_prompt
+
+    def _to_model_device(self, inputs: BatchFeature) -> BatchFeature:
+        """
+        Move the processed inputs to the model's device.
+        On GPUs, tensors are copied from pinned host memory on a dedicated stream, so that the copies do not
+        wait for, or block, work queued on the compute stream. The compute stream waits for the copies before
+        it uses the inputs.
+        """
+        if self._h2d_stream is None:
+            return inputs.to(self.model.device)
+        with torch.cuda.stream(self._h2d_stream):
+            for key, value in inputs.items():
+                if torch.is_tensor(value):
+                    inputs[key] = value.pin_memory().to(self.model.device, non_blocking=True)
+        compute_stream = torch.cuda.current_stream(self.model.device)
+        compute_stream.wait_stream(self._h2d_stream)
+        for value in inputs.values():
+            if torch.is_tensor(value):
+                # The tensors were allocated on the copy stream, but are used and freed on the compute stream
+                value.record_stream(compute_stream)
+        return inputs
+
+    def _prepare_inputs(self, convs: list[Conversation]) -> BatchFeature:
+        """
+        Render, tokenize and process the images of the conversations into a batch of model inputs on the model's device.
+        Either all or none of the conversations must contain images.
+        """
+        # Take out images from messages, grouped by conversation
+        images_per_conv: list[list[Image.Image]] = [
+            [
+                files.to_pil(content.image)
+                for message in conv.messages
+                for content in message.content
+                if type(content) is ContentImageMessage
+            ]
+            for conv in convs
+        ]
+
+        # Process text and images. Prompts are padded on the left so that all of them end where generation starts
+        input_texts = [self._apply_chat_template(conv.messages) for conv in convs]
         inputs = self.processor(
-            images,
-            input_text,
+            images=images_per_conv if any(images_per_conv) else None,
+            text=input_texts,
             add_special_tokens=False,
+            padding=True,
             return_tensors="pt",
-        ).to(self.model.device)
-
-        # Generate and decode
-        outputs = self.model.generate(
-            **inputs, temperature=self.temperature, max_new_tokens=self.max_tokens
-        )  # shape (1, output_length)
-        decoded_output = self.processor.decode(outputs[0])
-        user_assistant_alternate_messages: list[str] = decoded_output.split("assistant<|end_header_id|>")
-        latest_assistant_message: str = (
-            user_assistant_alternate_messages[-1].strip().rstrip("<|eot_id|>")
-            if user_assistant_alternate_messages
-            else ""
         )
-        return latest_assistant_message
+        return self._to_model_device(inputs)
+
+    def generate_responses(self, convs: list[Conversation]) -> list[str]:
+        """
+        Generate responses for multiple conversations in a single batched `generate` call, which loads the weights
+        once per decoding step for the whole batch instead of once per conversation.
+        Either all or none of the conversations must contain images.
+
+        Args:
+            convs (list[Conversation]): The conversation objects.
+
+        Returns:
+            list[str]: The responses generated by the model, in the order of `convs`.
+        """
+        inputs = self._prepare_inputs(convs)
+        # Prompts are left padded to the same length, so the generated tokens of every row start here
+        prompt_length = inputs["input_ids"].shape[1]
+
+        # Generate and decode only the generated tokens, without tracking tensors for autograd
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                **self._assistant_kwargs(inputs),
+                temperature=self.temperature,
+                max_new_tokens=self.max_tokens,
+            )  # shape (len(convs), output_length)
+        # Skipping special tokens drops the end of turn token and the padding after shorter responses
+        decoded_outputs = self.processor.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+        return [decoded_output.strip() for decoded_output in decoded_outputs]
+
+    def generate_response_stream(self, conv: Conversation) -> Iterator[str]:
+        """
+        Generate a response for the conversation, yielding text as soon as it is decoded.
+        Only the generated tokens are decoded, not the prompt.
+        """
+        inputs = self._prepare_inputs([conv])
+        streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors: list[BaseException] = []
+
+        def generate() -> None:
+            # Inference mode is thread-local, so enter it in the generating thread
+            try:
+                with torch.inference_mode():
+                    self.model.generate(
+                        **inputs,
+                        **self._assistant_kwargs(inputs),
+                        streamer=streamer,
+                        temperature=self.temperature,
+                        max_new_tokens=self.max_tokens,
+                    )
+            except BaseException as e:
+                errors.append(e)
+                # Stop the iteration below instead of waiting for text that never comes
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        yield from streamer
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def generate_response(self, conv: Conversation) -> str:
+        return "".join(self.generate_response_stream(conv)).strip()
@@ -1,10 +1,45 @@
+import httpx
 import ollama
 
-from _types import ContentTextMessage, Conversation
-from llm.common import CommonLLMChat
+from _types import ContentTextMessage, Message
+from llm import _http
+from llm.provider import ProviderChat, ProviderSpec
 
+# Ollama clients create their own httpx clients from these arguments. The local server does not redirect
+_CLIENT_KWARGS = dict(
+    host="http://localhost:11434",
+    follow_redirects=False,
+    limits=_http.LIMITS,
+)
+
+
+def _create(client: ollama.Client | ollama.AsyncClient, model: str, messages: list[dict], chat: "OllamaChat"):
+    options = dict(
+        temperature=chat.temperature,
+    )
+    return client.chat(
+        model=model,
+        messages=messages,
+        options=options,
+    )
+
+
+OLLAMA_SPEC = ProviderSpec(
+    make_client=lambda chat: ollama.Client(headers=chat.ollama_headers, **_CLIENT_KWARGS),
+    make_aclient=lambda chat: ollama.AsyncClient(headers=chat.ollama_headers, **_CLIENT_KWARGS),
+    create=_create,
+    response_text=lambda response: response.message.content,
+    # Removed before sending model names to the API, e.g. "ollama:llama3.2:1b"
+    prefix="ollama:",
+)
+
+
+class OllamaChat(ProviderChat):
+    SPEC = OLLAMA_SPEC
+    # Transient failures to reach the local server, e.g. while it is starting or loading a model. Recent ollama
+    # clients raise ConnectionError for failed connections
+    RETRYABLE_EXCEPTIONS = (httpx.ConnectError, httpx.ReadTimeout, ConnectionError)
 
-class OllamaChat(CommonLLMChat):
     def __init__(
         self,
         model_name: str,
@@ -12,42 +47,25 @@ class OllamaChat(CommonLLMChat):
         max_tokens: int = 4096,
         temperature: float = 0.0,
         seed: int = 0,
+        max_retries: int = 3,
+        wait_seconds: float = 1.0,
     ):
-        super().__init__(model_name, model_path, max_tokens, temperature, seed)
+        # Read by `OLLAMA_SPEC` when creating the clients
         self.ollama_headers: dict = {}
-        self.client = ollama.Client(
-            host="http://localhost:11434",
-            headers=self.ollama_headers,
-        )
+        super().__init__(model_name, model_path, max_tokens, temperature, seed, max_retries, wait_seconds)
 
-    def _convert_conv_to_api_format(self, conv: Conversation) -> list[dict]:
+    def _convert_message_to_api_format(self, message: Message) -> list[dict]:
         """
-        Converts conv into the following format and calls the Ollama client.
+        Converts the message into the following format, used by the Ollama client.
+        The text contents of a message are joined into one entry, since Ollama message contents are strings.
         ```
         [
             {"role": role1, "content": text1},
-            {"role": role2, "content": text2},
-            {"role": role3, "content": text3},
+            {"role": role2, "content": text2 + "\n" + text3},
+            {"role": role3, "content": text4},
         ]
         ```
         """
-        formatted_messages = []
-        for message in conv.messages:
-            for content in message.content:
-                match content:
-                    case ContentTextMessage(text=text):
-                        formatted_messages.append({"role": message.role, "content": text})
-                    # TODO figure out image parsing
-        return formatted_messages
-
-    def _call_api(self, messages_api_format: list[dict]) -> str:
-        options = dict(
-            temperature=self.temperature,
-        )
-        # Remove the "ollama:" prefix before setting up the client
-        response = self.client.chat(
-            model=self.model_name,
-            messages=messages_api_format,
-            options=options,
-        )
-        return response.message.content
+        # TODO figure out image parsing
+        texts = [content.text for content in message.content if type(content) is ContentTextMessage]
+        return [{"role": message.role, "content": "\n".join(texts)}] if texts else []
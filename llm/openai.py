@@ -2,33 +2,50 @@ import os
 
 import openai
 
-from llm.common import CommonLLMChat
-
-
-class OpenAIChat(CommonLLMChat):
-    def __init__(
-        self,
-        model_name: str,
-        model_path: str | None = None,
-        max_tokens: int = 4096,
-        temperature: float = 0.0,
-        seed: int = 0,
-    ):
-        """
-        Examples of model names:
-            "gpt-4o-mini-2024-07-18"
-            "gpt-4o-2024-11-20"
-        """
-        super().__init__(model_name, model_path, max_tokens, temperature, seed)
-        self.client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-    def _call_api(self, messages_api_format: list[dict]) -> str:
-        # https://platform.openai.com/docs/api-reference/introduction
-        completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages_api_format,
-            temperature=self.temperature,
-            max_completion_tokens=self.max_tokens,
-            seed=self.seed,
-        )
-        return completion.choices[0].message.content
+from llm import _http
+from llm.provider import ProviderChat, ProviderSpec
+
+
+def _create(client: openai.OpenAI | openai.AsyncOpenAI, model: str, messages: list[dict], chat: ProviderChat):
+    # https://platform.openai.com/docs/api-reference/introduction
+    return client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=chat.temperature,
+        max_completion_tokens=chat.max_tokens,
+        seed=chat.seed,
+    )
+
+
+def _response_text(completion) -> str:
+    return completion.choices[0].message.content
+
+
+OPENAI_SPEC = ProviderSpec(
+    make_client=lambda chat: openai.OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=chat.max_retries,
+        timeout=_http.TIMEOUT,
+        http_client=_http.HTTP_CLIENT,
+    ),
+    make_aclient=lambda chat: openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=chat.max_retries,
+        timeout=_http.TIMEOUT,
+        http_client=_http.ASYNC_HTTP_CLIENT,
+    ),
+    create=_create,
+    response_text=_response_text,
+)
+
+
+class OpenAIChat(ProviderChat):
+    """
+    Examples of model names:
+        "gpt-4o-mini-2024-07-18"
+        "gpt-4o-2024-11-20"
+    """
+
+    SPEC = OPENAI_SPEC
+    RETRYABLE_EXCEPTIONS = (openai.RateLimitError,)
+    _native_retries = True
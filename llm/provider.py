@@ -0,0 +1,59 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any, ClassVar
+
+from llm.common import CommonLLMChat
+
+
+@dataclass(frozen=True)
+class ProviderSpec:
+    """
+    What differs between API providers with chat completion style SDKs: how their clients are created,
+    how a request is sent, and where the response text is.
+
+    Attributes:
+        make_client (Callable[[ProviderChat], Any]): Creates the sync SDK client for the chat object.
+        make_aclient (Callable[[ProviderChat], Any]): Creates the async SDK client for the chat object.
+        create (Callable[[Any, str, list[dict], ProviderChat], Any]): Sends a request through a client, given the
+            model name to send, the messages, and the chat object for the sampling parameters. Called with the
+            async client, it returns an awaitable of the response.
+        response_text (Callable[[Any], str]): Extracts the generated text from the response.
+        prefix (str): Optional prefix of model names, e.g. "together:", removed before sending them to the API.
+    """
+
+    make_client: Callable[["ProviderChat"], Any]
+    make_aclient: Callable[["ProviderChat"], Any]
+    create: Callable[[Any, str, list[dict], "ProviderChat"], Any]
+    response_text: Callable[[Any], str]
+    prefix: str = ""
+
+
+class ProviderChat(CommonLLMChat):
+    """
+    LLM chat object for the API provider described by the `SPEC` of the subclass.
+    """
+
+    SPEC: ClassVar[ProviderSpec]
+
+    def __init__(
+        self,
+        model_name: str,
+        model_path: str | None = None,
+        max_tokens: int = 4096,
+        temperature: float = 0.0,
+        seed: int = 0,
+        max_retries: int = 3,
+        wait_seconds: float = 1.0,
+    ):
+        super().__init__(model_name, model_path, max_tokens, temperature, seed, max_retries, wait_seconds)
+        self.api_model_name = model_name.removeprefix(self.SPEC.prefix)
+        self.client = self.SPEC.make_client(self)
+        self.aclient = self.SPEC.make_aclient(self)
+
+    def _call_api(self, messages_api_format: list[dict]) -> str:
+        response = self.SPEC.create(self.client, self.api_model_name, messages_api_format, self)
+        return self.SPEC.response_text(response)
+
+    async def _acall_api(self, messages_api_format: list[dict]) -> str:
+        response = await self.SPEC.create(self.aclient, self.api_model_name, messages_api_format, self)
+        return self.SPEC.response_text(response)
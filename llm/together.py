@@ -2,40 +2,49 @@ import os
 
 import together
 
-from llm.common import CommonLLMChat
-
-
-class TogetherChat(CommonLLMChat):
-    def __init__(
-        self,
-        model_name: str,
-        model_path: str | None = None,
-        max_tokens: int = 4096,
-        temperature: float = 0.0,
-        seed: int = 0,
-    ):
-        """
-        Examples of model names:
-            "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
-            "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo"
-            "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo"
-            "meta-llama/Llama-Vision-Free"
-        """
-        super().__init__(model_name, model_path, max_tokens, temperature, seed)
-        self.client = together.Together(api_key=os.getenv("TOGETHER_API_KEY"))
+from llm.provider import ProviderChat, ProviderSpec
+
+
+def _create(client: together.Together | together.AsyncTogether, model: str, messages: list[dict], chat: ProviderChat):
+    # https://github.com/togethercomputer/together-python
+    return client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=chat.temperature,
+        seed=chat.seed,
+        max_tokens=chat.max_tokens,
+    )
+
+
+def _response_text(completion) -> str:
+    return completion.choices[0].message.content
+
+
+TOGETHER_SPEC = ProviderSpec(
+    make_client=lambda chat: together.Together(api_key=os.getenv("TOGETHER_API_KEY"), max_retries=chat.max_retries),
+    make_aclient=lambda chat: together.AsyncTogether(
+        api_key=os.getenv("TOGETHER_API_KEY"), max_retries=chat.max_retries
+    ),
+    create=_create,
+    response_text=_response_text,
+    # Removed before sending model names to the API
+    prefix="together:",
+)
+
+
+class TogetherChat(ProviderChat):
+    """
+    Examples of model names:
+        "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
+        "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo"
+        "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo"
+        "meta-llama/Llama-Vision-Free"
+    """
+
+    SPEC = TOGETHER_SPEC
+    RETRYABLE_EXCEPTIONS = (together.error.RateLimitError,)
+    _native_retries = True
 
     @staticmethod
     def is_model_supported(model_name: str) -> bool:
         return model_name.startswith("together:")
-
-    def _call_api(self, messages_api_format: list[dict]) -> str:
-        # https://github.com/togethercomputer/together-python
-        # Remove the "together:" prefix before setting up the client
-        completion = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages_api_format,
-            temperature=self.temperature,
-            seed=self.seed,
-            max_tokens=self.max_tokens,
-        )
-        return completion.choices[0].message.content
@@ -1,19 +1,29 @@
+import dataclasses
+
 import openai
 
-from llm.openai import OpenAIChat
+from llm import _http
+from llm.openai import OPENAI_SPEC, OpenAIChat
+
+# Same API as OpenAI, served locally. The shared HTTP clients send requests to the base URL of each SDK client
+VLLM_SPEC = dataclasses.replace(
+    OPENAI_SPEC,
+    make_client=lambda chat: openai.OpenAI(
+        base_url="http://localhost:8000/v1",
+        api_key="token-abc123",
+        max_retries=chat.max_retries,
+        timeout=_http.TIMEOUT,
+        http_client=_http.HTTP_CLIENT,
+    ),
+    make_aclient=lambda chat: openai.AsyncOpenAI(
+        base_url="http://localhost:8000/v1",
+        api_key="token-abc123",
+        max_retries=chat.max_retries,
+        timeout=_http.TIMEOUT,
+        http_client=_http.ASYNC_HTTP_CLIENT,
+    ),
+)
 
 
 class VLLMChat(OpenAIChat):
-    def __init__(
-        self,
-        model_name: str,
-        model_path: str | None = None,
-        max_tokens: int = 4096,
-        temperature: float = 0.0,
-        seed: int = 0,
-    ):
-        super().__init__(model_name, model_path, max_tokens, temperature, seed)
-        self.client = openai.OpenAI(
-            base_url="http://localhost:8000/v1",
-            api_key="token-abc123",
-        )
+    SPEC = VLLM_SPEC
@@ -1,22 +1,34 @@
 import argparse
-from datetime import datetime
+import functools
+import itertools
+import re
+import time
+from collections.abc import Iterator
 from pathlib import Path
 from typing import Literal
 
 import streamlit as st
-from PIL import Image
 
-from _types import ChatSession, ContentImageMessage, ContentTextMessage, Conversation, Message
+from _types import MSGPACK_SUFFIX, ChatSession, ContentImageMessage, ContentTextMessage, Conversation, Message
 from llm import SUPPORTED_LLM_SERVERS, get_llm
 from llm.common import LLMChat
 
 
+@st.cache_resource
+def get_init_image() -> ContentImageMessage:
+    """
+    Loads the initial image of a chat once per process, instead of on every cleared chat.
+    The image message is shared by the chats, and is not modified in place, so its encoded
+    and base64-encoded bytes are also reused.
+    """
+    return ContentImageMessage.from_path("assets/Image.jpg")
+
+
 def init_conv(add_init_image: bool = False) -> Conversation:
     content = []
     if add_init_image:
-        image = Image.open("assets/Image.jpg")
-        content.append(ContentImageMessage(image=image))
-    messages: list[Message] = [] if not content else [Message(role="user", content=content, created_at=datetime.now())]
+        content.append(get_init_image())
+    messages: list[Message] = [] if not content else [Message(role="user", content=content)]
     return Conversation(messages=messages)
 
 
@@ -42,18 +54,151 @@ def get_llm_chat(_args: argparse.Namespace) -> LLMChat:
     return get_llm(_args.server, _args.model_name, llm_kwargs)
 
 
+# Texts longer than this are not rendered as markdown, since parsing huge markdown can hang the browser
+MARKDOWN_SIZE_LIMIT = 20_000
+
+
+def is_markdown_size(text: str) -> bool:
+    """
+    Whether the text is short enough to be rendered as markdown, or rendering large messages as markdown
+    is forced from the sidebar.
+    """
+    return len(text) <= MARKDOWN_SIZE_LIMIT or st.session_state.get("force_markdown", False)
+
+
+# Replacements made by `format_md_text`, all in a single pass over the text
+_MD_REPLACEMENTS = {
+    "<think>": "<blockquote>",
+    "</think>": "</blockquote>",
+    r"\[": "$$",
+    r"\]": "$$",
+}
+_MD_REPLACEMENTS_RE = re.compile("|".join(re.escape(old) for old in _MD_REPLACEMENTS))
+
+
+# Streamlit redisplays the whole chat on every rerun. Texts of messages are the same str objects across reruns,
+# and strings cache their hash, so cache hits cost a dict lookup instead of formatting the text again
+@functools.lru_cache(maxsize=4096)
 def format_md_text(text: str) -> str:
     """
     Formats text for markdown display:
     - Encloses <think>...</think> in a blockquote.
     - Converts latex \[ and \] to $$.
     """
-    # Replace <think>...</think> with blockquote
-    text = text.replace("<think>", "<blockquote>").replace("</think>", "</blockquote>")
+    # Plain responses have nothing to replace, so skip the regex scan
+    if "think>" not in text and "\\[" not in text and "\\]" not in text:
+        return text
+    return _MD_REPLACEMENTS_RE.sub(lambda match: _MD_REPLACEMENTS[match.group(0)], text)
+
+
+def throttle(chunks: Iterator[str], min_interval: float = 0.1) -> Iterator[str]:
+    """
+    Batch streamed chunks of text, yielding at most one batch every `min_interval` seconds.
+    Every batch re-renders the text of the block being streamed, so fewer, larger chunks avoid
+    quadratic rendering of long blocks.
 
-    # Convert latex \[ and \] to $$
-    text = text.replace(r"\[", "$$").replace(r"\]", "$$")
-    return text
+    Args:
+        chunks (Iterator[str]): The streamed chunks of text.
+        min_interval (float): Minimum number of seconds between yielded batches.
+            Defaults to 0.1.
+
+    Yields:
+        str: The chunks received since the previous batch, joined.
+    """
+    batch: list[str] = []
+    # Yield the first chunk right away
+    last_yield_time = float("-inf")
+    for chunk in chunks:
+        batch.append(chunk)
+        if time.monotonic() - last_yield_time >= min_interval:
+            yield "".join(batch)
+            batch.clear()
+            last_yield_time = time.monotonic()
+    if batch:
+        yield "".join(batch)
+
+
+class BlockStreamWriter:
+    """
+    Displays streamed markdown as a sequence of blocks. Blocks completed by a blank line are rendered once
+    and frozen, and only the trailing, incomplete block is re-rendered as new text arrives.
+    Blocks are not split inside code fences, and blocks split inside <think>...</think> are rendered
+    as consecutive blockquotes. Blocks longer than `MARKDOWN_SIZE_LIMIT` are displayed as plain text,
+    unless rendering them as markdown is forced from the sidebar.
+    """
+
+    def __init__(self):
+        # Frozen blocks are rendered in the container, above the placeholder of the trailing block
+        self._container = st.container()
+        self._placeholder = st.empty()
+        self._chunks: list[str] = []
+        self._tail = ""
+        self._tail_in_think = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def _frozen_length(self) -> int:
+        # End of the last blank line in the trailing block that is outside of code fences, or 0 if there is none
+        boundary = self._tail.rfind("\n\n")
+        while boundary != -1 and self._tail.count("```", 0, boundary) % 2 == 1:
+            boundary = self._tail.rfind("\n\n", 0, boundary)
+        return boundary + 2 if boundary != -1 else 0
+
+    def _display(self, element, block: str, in_think: bool, is_complete: bool) -> bool:
+        # Display the block in the element. Returns whether the block ends inside <think>...</think>
+        text = "<think>" + block if in_think else block
+        ends_in_think = text.rfind("<think>") > text.rfind("</think>")
+        if not is_markdown_size(block):
+            # Parsing huge markdown on every write can hang the browser, like in `display_text`
+            element.text(block)
+            return ends_in_think
+        # Reopen and close the <think> tags of blocks split inside them
+        if ends_in_think:
+            text += "</think>"
+        # The trailing block changes on every write, so caching its formatting would only evict the cached history
+        format_text = format_md_text if is_complete else format_md_text.__wrapped__
+        element.markdown(format_text(text), unsafe_allow_html=True)
+        return ends_in_think
+
+    def write(self, chunk: str) -> None:
+        self._chunks.append(chunk)
+        self._tail += chunk
+        if frozen_length := self._frozen_length():
+            frozen, self._tail = self._tail[:frozen_length], self._tail[frozen_length:]
+            self._tail_in_think = self._display(self._container, frozen, self._tail_in_think, is_complete=True)
+        self._display(self._placeholder, self._tail, self._tail_in_think, is_complete=False)
+
+    def write_stream(self, chunks: Iterator[str]) -> str:
+        """
+        Display the streamed chunks of markdown.
+
+        Args:
+            chunks (Iterator[str]): The streamed chunks of text.
+
+        Returns:
+            str: The full text.
+        """
+        for chunk in chunks:
+            self.write(chunk)
+        return self.text
+
+
+def display_text(text: str) -> None:
+    """
+    Display the text of a message as markdown. Texts longer than `MARKDOWN_SIZE_LIMIT` are displayed as plain text
+    in a collapsed expander instead, unless rendering them as markdown is forced from the sidebar.
+
+    Args:
+        text (str): Text of the message.
+    """
+    if not is_markdown_size(text):
+        with st.expander(f"Large message ({len(text)} chars)", expanded=False):
+            st.text(text)
+        return
+    formatted_text = format_md_text(text)
+    st.markdown(formatted_text, unsafe_allow_html=True)
 
 
 def display_chat(chat_history: Conversation) -> None:
@@ -65,13 +210,19 @@ def display_chat(chat_history: Conversation) -> None:
     """
     for message in chat_history.messages:
         with st.chat_message(message.role):
-            for content in message.content:
-                match content:
-                    case ContentTextMessage(text=text):
-                        formatted_text = format_md_text(text)
-                        st.markdown(formatted_text, unsafe_allow_html=True)
-                    case ContentImageMessage(image=image):
-                        st.image(image, use_container_width=True)
+            # Display each run of consecutive texts with a single element, so that Streamlit sends the
+            # browser one update per run instead of one per text
+            for content_type, contents in itertools.groupby(message.content, key=type):
+                if content_type is ContentTextMessage:
+                    texts = [content.text for content in contents]
+                    # A single text is passed as is, keeping its cached formatting across reruns
+                    display_text(texts[0] if len(texts) == 1 else "\n\n".join(texts))
+                    continue
+                for content in contents:
+                    # Pass the encoded image, which Streamlit serves as is. Given a PIL image, it would
+                    # decode it first if needed, and then re-encode it on every rerun
+                    image_bytes, _ = content.to_bytes()
+                    st.image(image_bytes, use_container_width=True)
 
 
 def update_chat(role: Literal["user", "assistant"], text: str) -> None:
@@ -82,7 +233,7 @@ def update_chat(role: Literal["user", "assistant"], text: str) -> None:
         role (Literal["user", "assistant"]): Either "user" or "assistant".
         text (str): Content of the message.
     """
-    new_message = Message(role=role, content=[ContentTextMessage(text=text)], created_at=datetime.now())
+    new_message = Message(role=role, content=[ContentTextMessage(text=text)])
     st.session_state.chat_history.messages.append(new_message)
 
 
@@ -93,18 +244,30 @@ def clear_chat() -> None:
     st.session_state.chat_history = init_conv()
 
 
-def load_chat_from_path(file_path: str) -> None:
+def load_chat_from_path(file_path: str) -> bool:
     """
     Load chat history from a JSON file and update the chat history in streamlit's session state.
 
     Args:
         file_path (str): Path to the JSON file.
+
+    Returns:
+        bool: Whether the chat history was loaded.
     """
-    if not Path(file_path).expanduser().exists():
+    path = Path(file_path).expanduser()
+    if not path.exists():
         st.error(f"File does not exist: {file_path}")
-        return
-    chat_session = ChatSession.load_from_path(file_path)
+        return False
+    try:
+        chat_session = ChatSession.load_from_path(path, trust=True)
+    except (FileNotFoundError, ValueError) as e:
+        # E.g. a missing transcript, or the path of a transcript instead of its chat
+        st.error(f"Could not load chat from {file_path}: {e}")
+        return False
     st.session_state.chat_history = chat_session.conv
+    # Keep the loaded session, which knows its transcript, so that saving the chat back only appends new messages
+    st.session_state.chat_session = chat_session
+    return True
 
 
 def save_chat_to_path(file_path: str) -> None:
@@ -114,42 +277,62 @@ def save_chat_to_path(file_path: str) -> None:
     Args:
         file_path (str): Path to the JSON file.
     """
+    path = Path(file_path).expanduser()
     # If the file path directory does not exist, create it
-    Path(file_path).expanduser().parent.mkdir(parents=True, exist_ok=True)
-    # If the file path does not have a .json extension, add it
-    if Path(file_path).suffix != ".json":
-        file_path += ".json"
-    chat_session = ChatSession(
-        llm_name=st.session_state.llm_chat.model_name,
-        llm_kwargs=st.session_state.llm_chat.model_kwargs,
-        conv=st.session_state.chat_history,
-    )
-    chat_session.save_to_path(file_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # If the file path does not have a .json or .msgpack extension, add .json
+    if path.suffix not in (".json", MSGPACK_SUFFIX):
+        path = path.with_name(path.name + ".json")
+    # Reuse the session across saves, so that saving the same chat to the same path again only appends
+    # its new messages to the transcript
+    chat_session: ChatSession = st.session_state.chat_session
+    # Record the current LLM, also for chats loaded from files saved with another one
+    chat_session.llm_name = st.session_state.llm_chat.model_name
+    chat_session.llm_kwargs = st.session_state.llm_chat.model_kwargs
+    chat_session.conv = st.session_state.chat_history
+    chat_session.save_to_path(path)
 
 
 def display_sidebar() -> None:
     """
     Display the sidebar:
     - Button for Clear chat
+    - Toggle for rendering large messages as markdown
     - Widget for Load chat from file
     - Widget for Save chat to file
     """
     with st.sidebar:
         st.button("Clear chat", on_click=clear_chat)
+        st.toggle(
+            "Render large messages as markdown",
+            key="force_markdown",
+            help=f"Messages longer than {MARKDOWN_SIZE_LIMIT} characters are shown as plain text otherwise",
+        )
 
         st.divider()
 
-        st.subheader("Load chat")
-        load_file_path = st.text_input("JSON file path for loading chat")
-        st.button("Load chat", on_click=load_chat_from_path, args=(load_file_path.strip(),))
+        display_chat_files()
 
         st.divider()
 
-        st.subheader("Save chat")
-        save_file_path = st.text_input("JSON file path for saving chat")
-        st.button("Save chat", on_click=save_chat_to_path, args=(save_file_path.strip(),))
 
-        st.divider()
+@st.fragment
+def display_chat_files() -> None:
+    """
+    Display the widgets for loading and saving chats. They are a fragment, so that entering file paths
+    and saving chats rerun only these widgets instead of redisplaying the whole chat.
+    """
+    st.subheader("Load chat")
+    load_file_path = st.text_input("JSON file path for loading chat")
+    if st.button("Load chat") and load_chat_from_path(load_file_path.strip()):
+        # Redisplay the whole app with the loaded chat
+        st.rerun()
+
+    st.divider()
+
+    st.subheader("Save chat")
+    save_file_path = st.text_input("JSON file path for saving chat")
+    st.button("Save chat", on_click=save_chat_to_path, args=(save_file_path.strip(),))
 
 
 def ui_main(args: argparse.Namespace) -> None:
@@ -180,9 +363,12 @@ def ui_main(args: argparse.Namespace) -> None:
 
         # Generate assistant response
         with st.chat_message("assistant"):
-            response = llm_chat.generate_response(st.session_state.chat_history)
-            formatted_text = format_md_text(response)
-            st.markdown(formatted_text, unsafe_allow_html=True)
+            if args.stream_generations:
+                stream = throttle(llm_chat.generate_response_stream(st.session_state.chat_history))
+                response = BlockStreamWriter().write_stream(stream)
+            else:
+                response = llm_chat.generate_response(st.session_state.chat_history)
+                display_text(response)
 
         # Add assistant response to chat history
         update_chat(role="assistant", text=response)
@@ -211,6 +397,9 @@ if __name__ == "__main__":
         "--temperature", type=float, default=0.0, help="Temperature for the model's response generation"
     )
     parser.add_argument("--seed", type=int, default=0, help="Seed for the model")
+    parser.add_argument(
+        "--stream_generations", action="store_true", help="Display the model's response as it is generated"
+    )
     args = parser.parse_args()
 
     # Initialize conversation and LLM
@@ -218,13 +407,19 @@ if __name__ == "__main__":
     # HACK Feed an image at the beginning. Otherwise llama complains
     # is_hf_model = args.model_name in llm.HuggingfaceChat.SUPPORTED_LLM_NAMES
     is_hf_model = False
-    chat_history = init_conv(add_init_image=is_hf_model)
-    llm_chat: LLMChat = get_llm_chat(args)
-
+    # Streamlit reruns this script on every interaction. The LLM is cached across reruns by `get_llm_chat`,
+    # and the initial conversation is only created once per session
     if "llm_chat" not in st.session_state:
-        st.session_state.llm_chat = llm_chat
+        st.session_state.llm_chat = get_llm_chat(args)
 
     if "chat_history" not in st.session_state:
-        st.session_state.chat_history = chat_history
+        st.session_state.chat_history = init_conv(add_init_image=is_hf_model)
+
+    if "chat_session" not in st.session_state:
+        st.session_state.chat_session = ChatSession(
+            llm_name=st.session_state.llm_chat.model_name,
+            llm_kwargs=st.session_state.llm_chat.model_kwargs,
+            conv=st.session_state.chat_history,
+        )
 
     ui_main(args)